@@ -0,0 +1,62 @@
+"""
+Benchmark parse_instantaneous_report against a plain regex baseline,
+the way the report is typically parsed by hand: decode the JSON, split per
+phase and search every field with its own (uncompiled) pattern.
+
+Usage: python benchmarks/bench_report.py
+"""
+
+import json
+import os
+import re
+import sys
+import timeit
+
+# run from a checkout, without installing smappy
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from smappy.report import FIELDS, parse_instantaneous_report  # noqa: E402
+
+PHASE = ("Phase {n}:<BR>&nbsp;&nbsp;current={c:.3f} A, "
+         "activePower={p:.3f} W, reactivePower={q:.3f} var, "
+         "apparentPower={s:.3f} VA, cosfi={cosfi}, quadrant=0, "
+         "phaseshift=0.0, phaseDiff=0.0<BR>&nbsp;&nbsp;FFTComponents:<BR>")
+
+REPORT = json.dumps({
+    'report': "Instantaneous values:<BR>voltage=230.1 Vrms<BR>"
+              "frequency=50.02 Hz<BR>" +
+              ''.join(PHASE.format(n=n, c=1.057 * n, p=178.0 * n,
+                                   q=165.0 * n, s=243.0 * n, cosfi=73)
+                      for n in range(1, 4))
+}).encode('utf-8')
+
+
+def baseline(body):
+    report = json.loads(body.decode('utf-8'))['report']
+    parts = re.split(r'Phase (\d+):', report)
+    result = {'phases': {}}
+    for field in FIELDS:
+        m = re.search(field + r'=(-?[\d.]+)', parts[0])
+        if m:
+            result[field] = float(m.group(1))
+    for n, text in zip(parts[1::2], parts[2::2]):
+        phase = result['phases'][int(n)] = {}
+        for field in FIELDS:
+            m = re.search(r'\b' + field + r'=(-?[\d.]+)', text)
+            if m:
+                phase[field] = float(m.group(1))
+    return result
+
+
+def main(number=20000):
+    assert baseline(REPORT) == parse_instantaneous_report(REPORT)
+    for name, func in [('baseline', baseline),
+                       ('parse_instantaneous_report',
+                        parse_instantaneous_report)]:
+        t = min(timeit.repeat(lambda: func(REPORT), number=number, repeat=3))
+        print("{:<28} {:8.2f} us/report".format(name, t / number * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -75,6 +75,20 @@ setup(
     # your project is installed.
     install_requires=['requests', 'pytz'],
 
+    # Optional dependencies, install with `pip install smappy[http2]`
+    extras_require={
+        'http2': ['httpx[http2]'],
+    },
+
+    # To provide executable scripts, use entry points in preference to the
+    # "scripts" keyword. Entry points provide cross-platform support and allow
+    # pip to create the appropriate form of executable for the target platform.
+    entry_points={
+        'console_scripts': [
+            'smappy-backfill=smappy.backfill:main',
+        ],
+    },
+
     # If there are data files included in your packages that need to be
     # installed, specify them here.  If using Python 2.6 or less, then these
     # have to be included in MANIFEST.in as well.
@@ -1 +1,10 @@
 from .smappy import Smappee, SimpleSmappee, LocalSmappee, __version__
+from .tokenstore import TokenStore, FileTokenStore, SqliteTokenStore
+from .report import parse_instantaneous_report
+from .energy import EnergyAccumulator
+from .health import GatewayHealth, GatewayUnavailable
+from .transport import Transport, RequestsTransport, HTTPXTransport
+from .pool import ClientPool, PooledSmappee
+from .scheduler import PriorityTransport, QueueFull, priority, CONTROL, INTERACTIVE, BULK
+from .usage import appliance_usage
+from .replay import RecordingTransport, ReplayTransport, ReplayMiss
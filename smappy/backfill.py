@@ -0,0 +1,405 @@
+"""
+Backfill consumption, sensor consumption and events of all service locations
+into a local columnar store (one Parquet or CSV file per task).
+
+The period is cut into (location, window) tasks which run on a process pool.
+Every finished task is appended to a checkpoint file, so a killed job picks
+up where it stopped when it is started again with the same output directory.
+
+Usage: smappy-backfill --help
+"""
+
+import argparse
+import datetime as dt
+import json
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from .smappy import Smappee
+from .tokenstore import FileTokenStore, SqliteTokenStore
+
+log = logging.getLogger(__name__)
+
+CHECKPOINT_FILE = '_checkpoint.jsonl'
+
+# the client of the worker process, created by _init_worker
+_client = None
+
+
+def make_windows(start, end, window):
+    """
+    Cut a period into consecutive windows
+
+    Parameters
+    ----------
+    start : dt.datetime
+    end : dt.datetime
+    window : dt.timedelta
+
+    Returns
+    -------
+    [(dt.datetime, dt.datetime)]
+    """
+    windows = []
+    while start < end:
+        windows.append((start, min(start + window, end)))
+        start += window
+    return windows
+
+
+def make_tasks(client, start, end, window, sensors=True, events=True):
+    """
+    List all tasks for all service locations
+
+    Parameters
+    ----------
+    client : Smappee
+    start : dt.datetime
+    end : dt.datetime
+    window : dt.timedelta
+    sensors : bool
+        default True, include sensor consumption
+    events : bool
+        default True, include appliance events
+
+    Returns
+    -------
+    [dict]
+        each task has the keys 'kind' ('consumption', 'sensor' or 'events'),
+        'service_location_id', 'sub_id' (sensor or appliance id, else None),
+        'start' and 'end' (epoch milliseconds)
+    """
+    windows = [(client._to_milliseconds(s), client._to_milliseconds(e))
+               for s, e in make_windows(start, end, window)]
+    locations = client.get_service_locations()['serviceLocations']
+    tasks = []
+    for location in locations:
+        location_id = location['serviceLocationId']
+        subs = [('consumption', None)]
+        if sensors or events:
+            info = client.get_service_location_info(location_id)
+            if sensors:
+                subs += [('sensor', s['id']) for s in info.get('sensors', [])]
+            if events:
+                subs += [('events', a['id'])
+                         for a in info.get('appliances', [])]
+        for kind, sub_id in subs:
+            for s, e in windows:
+                tasks.append({'kind': kind, 'service_location_id': location_id,
+                              'sub_id': sub_id, 'start': s, 'end': e})
+    return tasks
+
+
+def task_key(task):
+    """
+    Parameters
+    ----------
+    task : dict
+
+    Returns
+    -------
+    str
+        unique name of the task, also used as its file name in the store.
+        Consumption tasks include the aggregation, so a run with another
+        aggregation doesn't skip them or mix them in the same files.
+    """
+    if task['kind'] == 'events':
+        return '{kind}/{service_location_id}/{sub_id}/{start}-{end}'.format(
+            **task)
+    return ('{kind}/aggregation-{aggregation}/{service_location_id}/'
+            '{sub_id}/{start}-{end}').format(**task)
+
+
+def load_checkpoint(output):
+    """
+    Parameters
+    ----------
+    output : str
+        output directory
+
+    Returns
+    -------
+    set
+        keys of the tasks that are done
+    """
+    path = os.path.join(output, CHECKPOINT_FILE)
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, 'r') as f:
+        for line in f:
+            try:
+                done.add(json.loads(line)['key'])
+            except ValueError:
+                # the last line may be cut off when the job was killed
+                continue
+    return done
+
+
+def write_checkpoint(output, task, rows):
+    """
+    Mark a task as done
+
+    Parameters
+    ----------
+    output : str
+    task : dict
+    rows : int
+    """
+    path = os.path.join(output, CHECKPOINT_FILE)
+    with open(path, 'a') as f:
+        f.write(json.dumps({'key': task_key(task), 'rows': rows}) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def fetch(client, task):
+    """
+    Request the data of a task
+
+    Parameters
+    ----------
+    client : Smappee
+    task : dict
+
+    Returns
+    -------
+    pd.DataFrame
+    """
+    import pandas as pd
+
+    kind = task['kind']
+    if kind == 'consumption':
+        df = client.get_consumption_dataframe(
+            service_location_id=task['service_location_id'],
+            start=task['start'], end=task['end'],
+            aggregation=task['aggregation'])
+    elif kind == 'sensor':
+        df = client.get_consumption_dataframe(
+            service_location_id=task['service_location_id'],
+            start=task['start'], end=task['end'],
+            aggregation=task['aggregation'], sensor_id=task['sub_id'])
+    elif kind == 'events':
+        events = client.get_events(
+            service_location_id=task['service_location_id'],
+            appliance_id=task['sub_id'], start=task['start'], end=task['end'])
+        df = pd.DataFrame.from_dict(events)
+        if not df.empty:
+            df.set_index('timestamp', inplace=True)
+            df.index = pd.to_datetime(df.index, unit='ms', utc=True)
+    else:
+        raise ValueError("Unknown task kind: {}".format(kind))
+    return df
+
+
+def write(df, path, fmt):
+    """
+    Write a frame to the store, through a temporary file so a killed job
+    never leaves a half written file behind
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+    path : str
+        without extension
+    fmt : str
+        'parquet' or 'csv'
+    """
+    path = '{}.{}'.format(path, fmt)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + '.tmp'
+    if fmt == 'parquet':
+        df.to_parquet(tmp_path)
+    else:
+        df.to_csv(tmp_path)
+    os.replace(tmp_path, path)
+
+
+def _init_worker(client_id, client_secret, username, password, token_path):
+    """
+    Creates the client of a worker process. All workers share one token
+    through the token store, so only one of them authenticates.
+    """
+    global _client
+    if token_path.endswith('.db'):
+        store = SqliteTokenStore(token_path)
+    else:
+        store = FileTokenStore(token_path)
+    _client = Smappee(client_id, client_secret, token_store=store)
+    _client.authenticate(username, password)
+
+
+def run_task(task, output, fmt, retries=3, backoff=2):
+    """
+    Fetch and store one task in a worker process, retrying on failure
+
+    Parameters
+    ----------
+    task : dict
+    output : str
+    fmt : str
+    retries : int
+        default 3
+    backoff : float
+        default 2, seconds to wait before the first retry,
+        doubles for every next one
+
+    Returns
+    -------
+    (dict, int)
+        the task and the number of rows written
+    """
+    for attempt in range(retries + 1):
+        try:
+            df = fetch(_client, task)
+            break
+        except Exception:
+            if attempt == retries:
+                raise
+            log.warning("Task %s failed, retry %d of %d", task_key(task),
+                        attempt + 1, retries, exc_info=True)
+            time.sleep(backoff * 2 ** attempt)
+    if not df.empty:
+        write(df, os.path.join(output, task_key(task)), fmt)
+    return task, len(df)
+
+
+def backfill(client_id, client_secret, username, password, output, start,
+             end, aggregation=2, window=dt.timedelta(days=30), workers=4,
+             retries=3, fmt='parquet', sensors=True, events=True,
+             token_path=None):
+    """
+    Backfill all service locations of an account
+
+    Parameters
+    ----------
+    client_id : str
+    client_secret : str
+    username : str
+    password : str
+    output : str
+        directory of the store, also holds the checkpoint
+    start : dt.datetime
+    end : dt.datetime
+    aggregation : int
+        default 2 (hourly)
+    window : dt.timedelta
+        default 30 days
+    workers : int
+        default 4
+    retries : int
+        default 3, retries per task
+    fmt : str
+        'parquet' (default) or 'csv'
+    sensors : bool
+        default True
+    events : bool
+        default True
+    token_path : str, optional
+        token store shared by the workers, a SqliteTokenStore if it ends
+        with '.db', else a FileTokenStore. Created readable by the owner only.
+        Default '_token.json' in the output directory.
+
+    Returns
+    -------
+    int
+        number of tasks that failed
+    """
+    os.makedirs(output, exist_ok=True)
+    if token_path is None:
+        token_path = os.path.join(output, '_token.json')
+    _init_worker(client_id, client_secret, username, password, token_path)
+    tasks = make_tasks(_client, start=start, end=end, window=window,
+                       sensors=sensors, events=events)
+    for task in tasks:
+        task['aggregation'] = aggregation
+
+    done = load_checkpoint(output)
+    todo = [task for task in tasks if task_key(task) not in done]
+    log.info("%d tasks, %d done, %d to do", len(tasks), len(tasks) - len(todo),
+             len(todo))
+
+    failed = 0
+    init_args = (client_id, client_secret, username, password, token_path)
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=init_args) as pool:
+        futures = {pool.submit(run_task, task, output, fmt, retries): task
+                   for task in todo}
+        for i, future in enumerate(as_completed(futures), 1):
+            task = futures[future]
+            try:
+                _, rows = future.result()
+            except Exception:
+                failed += 1
+                log.exception("Task %s failed", task_key(task))
+                continue
+            # only the parent writes the checkpoint, so lines never interleave
+            write_checkpoint(output, task, rows)
+            log.info("[%d/%d] %s: %d rows", i, len(todo), task_key(task), rows)
+    return failed
+
+
+def _parse_date(s):
+    return dt.datetime.strptime(s, '%Y-%m-%d')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='smappy-backfill',
+        description="Backfill consumption, sensor consumption and events of "
+                    "all service locations into a local store. Run again "
+                    "with the same output directory to resume.")
+    parser.add_argument('output', help="output directory")
+    parser.add_argument('--client-id',
+                        default=os.environ.get('SMAPPEE_CLIENT_ID'))
+    parser.add_argument('--client-secret',
+                        default=os.environ.get('SMAPPEE_CLIENT_SECRET'))
+    parser.add_argument('--username',
+                        default=os.environ.get('SMAPPEE_USERNAME'))
+    parser.add_argument('--password',
+                        default=os.environ.get('SMAPPEE_PASSWORD'))
+    parser.add_argument('--start', type=_parse_date, required=True,
+                        help="YYYY-MM-DD, in UTC")
+    parser.add_argument('--end', type=_parse_date,
+                        default=dt.datetime.utcnow().replace(
+                            hour=0, minute=0, second=0, microsecond=0),
+                        help="YYYY-MM-DD, in UTC, default today")
+    parser.add_argument('--aggregation', type=int, default=2,
+                        choices=[1, 2, 3, 4, 5])
+    parser.add_argument('--window-days', type=int, default=30)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--retries', type=int, default=3)
+    parser.add_argument('--format', dest='fmt', default='parquet',
+                        choices=['parquet', 'csv'])
+    parser.add_argument('--no-sensors', dest='sensors', action='store_false')
+    parser.add_argument('--no-events', dest='events', action='store_false')
+    parser.add_argument('--token-path',
+                        help="token store shared by the workers (.db for "
+                             "SQLite), default _token.json in the output "
+                             "directory")
+    args = parser.parse_args(argv)
+
+    for name in ['client_id', 'client_secret', 'username', 'password']:
+        if getattr(args, name) is None:
+            parser.error("--{} (or SMAPPEE_{}) is required".format(
+                name.replace('_', '-'), name.upper()))
+
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(levelname)s %(message)s')
+    failed = backfill(
+        client_id=args.client_id, client_secret=args.client_secret,
+        username=args.username, password=args.password, output=args.output,
+        start=args.start, end=args.end, aggregation=args.aggregation,
+        window=dt.timedelta(days=args.window_days), workers=args.workers,
+        retries=args.retries, fmt=args.fmt, sensors=args.sensors,
+        events=args.events, token_path=args.token_path)
+    if failed:
+        log.error("%d tasks failed, run again to retry them", failed)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,229 @@
+"""
+Integrate polled instantaneous active power into energy, without storing
+the samples.
+
+    acc = EnergyAccumulator()
+    while True:
+        acc.add_instantaneous(ls.load_instantaneous())
+        print(acc.energy())
+        time.sleep(5)
+"""
+
+import time
+from collections import deque
+
+TOTAL = 'total'
+
+
+class _Window(object):
+    """
+    Rolling min, max and mean over the last `size` values,
+    in O(1) amortized time per value and fixed memory
+    """
+    def __init__(self, size):
+        self.size = size
+        self.values = deque(maxlen=size)
+        self.total = 0.
+        # monotonic deques of (index, value)
+        self.mins = deque()
+        self.maxs = deque()
+        self.index = 0
+
+    def add(self, value):
+        if len(self.values) == self.size:
+            self.total -= self.values[0]
+        self.values.append(value)
+        self.total += value
+
+        first = self.index - self.size + 1
+        while self.mins and self.mins[-1][1] >= value:
+            self.mins.pop()
+        self.mins.append((self.index, value))
+        if self.mins[0][0] < first:
+            self.mins.popleft()
+        while self.maxs and self.maxs[-1][1] <= value:
+            self.maxs.pop()
+        self.maxs.append((self.index, value))
+        if self.maxs[0][0] < first:
+            self.maxs.popleft()
+        self.index += 1
+
+    def stats(self):
+        if not self.values:
+            return {'min': None, 'max': None, 'mean': None}
+        return {'min': self.mins[0][1], 'max': self.maxs[0][1],
+                'mean': self.total / len(self.values)}
+
+    def state(self):
+        return {'size': self.size, 'values': list(self.values),
+                'index': self.index, 'mins': [list(m) for m in self.mins],
+                'maxs': [list(m) for m in self.maxs]}
+
+    @classmethod
+    def from_state(cls, state):
+        w = cls(state['size'])
+        w.values.extend(state['values'])
+        w.total = float(sum(w.values))
+        w.index = state['index']
+        w.mins.extend(tuple(m) for m in state['mins'])
+        w.maxs.extend(tuple(m) for m in state['maxs'])
+        return w
+
+
+class EnergyAccumulator(object):
+    """
+    Integrates active power samples (in W) to energy (in kWh) per phase and
+    in total, with the trapezoidal rule. Keeps rolling min, max and mean power
+    over the last samples. Every sample is processed in O(1), samples are
+    not stored.
+    """
+    def __init__(self, max_gap=60, window=60):
+        """
+        Parameters
+        ----------
+        max_gap : float
+            default 60
+            if two samples are more than max_gap seconds apart, nothing is
+            integrated between them: the interval is counted as a gap
+        window : int
+            default 60, number of samples for the rolling statistics
+        """
+        self.max_gap = max_gap
+        self.window = window
+        self.last_time = None
+        self.last_values = {}
+        self.energy_ws = {}  # channel: Ws
+        self.windows = {}
+        self.samples = 0
+        self.gaps = 0
+        self.gap_seconds = 0.
+
+    def add(self, values, timestamp=None):
+        """
+        Add a sample
+
+        Parameters
+        ----------
+        values : dict
+            {phase: active power in W}, the total is computed as the sum.
+            Phases are converted to str, so they survive the JSON round
+            trip of state() and from_state()
+        timestamp : float, optional
+            epoch seconds, default now
+
+        Returns
+        -------
+        bool
+            False if the sample was dropped because it is not newer than the
+            previous one
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        if self.last_time is not None and timestamp <= self.last_time:
+            return False
+
+        values = {str(channel): value for channel, value in values.items()}
+        values[TOTAL] = sum(values.values())
+
+        if self.last_time is not None:
+            elapsed = timestamp - self.last_time
+            if elapsed > self.max_gap:
+                self.gaps += 1
+                self.gap_seconds += elapsed
+            else:
+                for channel, value in values.items():
+                    previous = self.last_values.get(channel)
+                    if previous is None:
+                        continue
+                    self.energy_ws[channel] = self.energy_ws.get(
+                        channel, 0.) + (previous + value) / 2 * elapsed
+
+        for channel, value in values.items():
+            if channel not in self.windows:
+                self.windows[channel] = _Window(self.window)
+            self.windows[channel].add(value)
+
+        self.last_time = timestamp
+        self.last_values = values
+        self.samples += 1
+        return True
+
+    def add_instantaneous(self, inst, timestamp=None):
+        """
+        Add a sample from LocalSmappee.load_instantaneous
+
+        Parameters
+        ----------
+        inst : list
+            [{'key': 'phase0ActivePower', 'value': '230'}, ...]
+        timestamp : float, optional
+            epoch seconds, default now
+
+        Returns
+        -------
+        bool
+        """
+        values = {i['key'][:-len('ActivePower')]: float(i['value'])
+                  for i in inst if i['key'].endswith('ActivePower')}
+        return self.add(values, timestamp=timestamp)
+
+    def energy(self):
+        """
+        Returns
+        -------
+        dict
+            {channel: kWh}, the channels are the phases (as str) and 'total'
+        """
+        return {channel: ws / 3.6e6 for channel, ws in self.energy_ws.items()}
+
+    def stats(self):
+        """
+        Returns
+        -------
+        dict
+            {channel: {'min': W, 'max': W, 'mean': W}} over the last
+            `window` samples
+        """
+        return {channel: w.stats() for channel, w in self.windows.items()}
+
+    def state(self):
+        """
+        Returns
+        -------
+        dict
+            JSON-serializable checkpoint, restore with from_state
+        """
+        return {
+            'max_gap': self.max_gap,
+            'window': self.window,
+            'last_time': self.last_time,
+            'last_values': self.last_values,
+            'energy_ws': self.energy_ws,
+            'windows': {c: w.state() for c, w in self.windows.items()},
+            'samples': self.samples,
+            'gaps': self.gaps,
+            'gap_seconds': self.gap_seconds
+        }
+
+    @classmethod
+    def from_state(cls, state):
+        """
+        Parameters
+        ----------
+        state : dict
+            as returned by state()
+
+        Returns
+        -------
+        EnergyAccumulator
+        """
+        acc = cls(max_gap=state['max_gap'], window=state['window'])
+        acc.last_time = state['last_time']
+        acc.last_values = dict(state['last_values'])
+        acc.energy_ws = dict(state['energy_ws'])
+        acc.windows = {c: _Window.from_state(w)
+                       for c, w in state['windows'].items()}
+        acc.samples = state['samples']
+        acc.gaps = state['gaps']
+        acc.gap_seconds = state['gap_seconds']
+        return acc
@@ -0,0 +1,213 @@
+"""
+Latency tracking and circuit breaker for LocalSmappee gateways
+"""
+
+import threading
+import time
+from collections import deque
+
+import requests
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class GatewayUnavailable(requests.exceptions.ConnectionError):
+    """
+    Raised without making a request while the circuit of a gateway is open
+    """
+    pass
+
+
+class GatewayHealth(object):
+    """
+    Keeps track of the latency and failures of one gateway.
+
+    The timeout of a request is derived from the observed latencies:
+    `percentile` of the last `samples` latencies times `multiplier`, bounded
+    by `min_timeout` and `max_timeout`.
+
+    After `failure_threshold` consecutive connection failures or timeouts
+    the circuit opens: requests fail fast with GatewayUnavailable. After
+    `reset_timeout` seconds (doubling on every failed probe, up to
+    `max_reset_timeout`) the gateway is probed. With a `probe` callable
+    this happens in a background thread, otherwise the next request is let
+    through as the probe (half open). A successful probe closes the circuit.
+    """
+    def __init__(self, min_timeout=0.5, max_timeout=5, percentile=99,
+                 multiplier=3, samples=100, failure_threshold=3,
+                 reset_timeout=10, max_reset_timeout=300, probe=None):
+        """
+        Parameters
+        ----------
+        min_timeout : float
+            default 0.5 seconds
+        max_timeout : float
+            default 5 seconds, also used until there are latencies
+        percentile : float
+            default 99
+        multiplier : float
+            default 3
+        samples : int
+            default 100, number of latencies kept
+        failure_threshold : int
+            default 3
+        reset_timeout : float
+            default 10 seconds
+        max_reset_timeout : float
+            default 300 seconds
+        probe : callable, optional
+            called without arguments in a background thread to check if the
+            gateway is back, should raise if it isn't.
+            LocalSmappee sets it when it is None
+        """
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.percentile = percentile
+        self.multiplier = multiplier
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.max_reset_timeout = max_reset_timeout
+        self.probe = probe
+
+        # latencies and opened_at use the monotonic clock, so they are not
+        # affected by changes of the wall clock
+        self.latencies = deque(maxlen=samples)
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.current_reset_timeout = reset_timeout
+        self.counters = {'requests': 0, 'successes': 0, 'failures': 0,
+                         'rejected': 0, 'opened': 0, 'probes': 0}
+        self._lock = threading.Lock()
+        self._probe_timer = None
+
+    def timeout(self):
+        """
+        Returns
+        -------
+        float
+            timeout in seconds for the next request
+        """
+        with self._lock:
+            if not self.latencies:
+                return self.max_timeout
+            latencies = sorted(self.latencies)
+        i = min(len(latencies) - 1,
+                int(len(latencies) * self.percentile / 100.))
+        timeout = latencies[i] * self.multiplier
+        return min(self.max_timeout, max(self.min_timeout, timeout))
+
+    def before_request(self):
+        """
+        Check whether a request may be made
+
+        Raises
+        ------
+        GatewayUnavailable
+            if the circuit is open
+        """
+        with self._lock:
+            self.counters['requests'] += 1
+            if self.state == CLOSED:
+                return
+            elapsed = time.monotonic() - self.opened_at
+            if self.state == OPEN and self.probe is None and \
+               elapsed >= self.current_reset_timeout:
+                # let this request through as the probe
+                self.state = HALF_OPEN
+                self.counters['probes'] += 1
+                return
+            self.counters['rejected'] += 1
+        raise GatewayUnavailable("Gateway is unavailable, circuit is "
+                                 "{}".format(self.state))
+
+    def record_success(self, latency):
+        """
+        Parameters
+        ----------
+        latency : float | None
+            seconds, None for a call whose latency should not be tracked
+        """
+        with self._lock:
+            if latency is not None:
+                self.latencies.append(latency)
+            self.counters['successes'] += 1
+            self._close()
+
+    def record_failure(self):
+        with self._lock:
+            self.counters['failures'] += 1
+            self.consecutive_failures += 1
+            if self.state == HALF_OPEN:
+                self._open(backoff=True)
+            elif self.state == CLOSED and \
+                    self.consecutive_failures >= self.failure_threshold:
+                self._open(backoff=False)
+
+    def _close(self):
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.current_reset_timeout = self.reset_timeout
+
+    def _open(self, backoff):
+        if backoff:
+            self.current_reset_timeout = min(self.max_reset_timeout,
+                                             self.current_reset_timeout * 2)
+        else:
+            self.counters['opened'] += 1
+        self.state = OPEN
+        self.opened_at = time.monotonic()
+        if self.probe is not None:
+            self._probe_timer = threading.Timer(self.current_reset_timeout,
+                                                self._run_probe)
+            self._probe_timer.daemon = True
+            self._probe_timer.start()
+
+    def _run_probe(self):
+        with self._lock:
+            if self.state != OPEN:
+                return
+            self.state = HALF_OPEN
+            self.counters['probes'] += 1
+        start = time.monotonic()
+        try:
+            self.probe()
+        except Exception:
+            self.record_failure()
+        else:
+            self.record_success(time.monotonic() - start)
+
+    def status(self):
+        """
+        Returns
+        -------
+        dict
+            state, timeout, latency percentiles and counters
+        """
+        timeout = self.timeout()
+        with self._lock:
+            latencies = sorted(self.latencies)
+            d = {
+                'state': self.state,
+                'timeout': timeout,
+                'consecutive_failures': self.consecutive_failures,
+                'reset_timeout': self.current_reset_timeout,
+            }
+            d.update(self.counters)
+        for p in (50, 90, 99):
+            if latencies:
+                d['p{}'.format(p)] = latencies[
+                    min(len(latencies) - 1, int(len(latencies) * p / 100.))]
+            else:
+                d['p{}'.format(p)] = None
+        return d
+
+    def close(self):
+        """
+        Stop a pending background probe
+        """
+        if self._probe_timer is not None:
+            self._probe_timer.cancel()
@@ -0,0 +1,306 @@
+"""
+Pool of SimpleSmappee clients for many tenants (access tokens)
+
+All clients of a pool share one transport (and so one connection pool),
+one metadata cache and one concurrency budget. Every tenant can have at
+most `tenant_quota` requests in flight, so a heavy tenant can't take the
+whole budget. Idle tenants are evicted, least recently used first.
+
+    pool = ClientPool(max_concurrency=32, tenant_quota=4)
+    s = pool.client(access_token)
+    s.get_consumption(...)
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import requests
+
+from .smappy import SimpleSmappee
+from .transport import Transport, RequestsTransport
+
+
+class _Tenant(object):
+    def __init__(self, quota):
+        self.semaphore = threading.BoundedSemaphore(quota)
+        self.active = 0  # requests waiting for a slot or in flight
+        self.in_flight = 0
+        self.requests = 0
+        self.wait_time = 0.
+        self.last_used = time.time()
+        self.client = None
+
+
+class _TenantTransport(Transport):
+    """
+    Transport of one tenant: takes a slot of the tenant's quota and of the
+    pool's budget, then uses the shared transport.
+    The tenant is looked up by access token on every request, so a client
+    handed out before its tenant was evicted shares the quota of the
+    re-registered tenant instead of getting its own.
+    """
+    def __init__(self, pool, access_token):
+        self.pool = pool
+        self.access_token = access_token
+
+    def request(self, method, url, **kwargs):
+        with self.pool._slot(self.access_token):
+            return self.pool.transport.request(method, url, **kwargs)
+
+
+class PooledSmappee(SimpleSmappee):
+    """
+    SimpleSmappee handed out by a ClientPool. Service locations and service
+    location info are served from the pool's metadata cache.
+    """
+    def __init__(self, access_token, pool, transport):
+        """
+        Parameters
+        ----------
+        access_token : str
+        pool : ClientPool
+        transport : Transport
+        """
+        super(PooledSmappee, self).__init__(access_token=access_token,
+                                            transport=transport)
+        self.pool = pool
+
+    def get_service_locations(self):
+        return self.pool._cached(
+            (self.access_token, 'servicelocations'),
+            super(PooledSmappee, self).get_service_locations)
+
+    def get_service_location_info(self, service_location_id):
+        return self.pool._cached(
+            (self.access_token, 'info', service_location_id),
+            lambda: super(PooledSmappee, self).get_service_location_info(
+                service_location_id))
+
+
+class ClientPool(object):
+    """
+    Maps access tokens to PooledSmappee clients sharing one transport,
+    metadata cache and concurrency budget
+    """
+    def __init__(self, transport=None, max_tenants=1000, max_concurrency=32,
+                 tenant_quota=4, cache_ttl=300, cache_size=10000):
+        """
+        Parameters
+        ----------
+        transport : Transport, optional
+            shared by all clients, default a RequestsTransport that keeps
+            max_concurrency connections per host. A transport you pass
+            should keep at least that many connections (eg. pool_maxsize of
+            a requests HTTPAdapter, which defaults to 10), or connections
+            are thrown away and reopened under load.
+        max_tenants : int
+            default 1000, the least recently used idle tenants are evicted
+            when there are more
+        max_concurrency : int
+            default 32, requests in flight over all tenants
+        tenant_quota : int
+            default 4, requests in flight per tenant
+        cache_ttl : float
+            default 300, seconds metadata stays in the cache
+        cache_size : int
+            default 10000, number of metadata entries in the cache
+        """
+        if transport is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=1, pool_maxsize=max_concurrency)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            transport = RequestsTransport(session=session)
+        self.transport = transport
+        self.max_tenants = max_tenants
+        self.tenant_quota = tenant_quota
+        self.cache_ttl = cache_ttl
+        self.cache_size = cache_size
+        self.max_concurrency = max_concurrency
+
+        self._budget = threading.BoundedSemaphore(max_concurrency)
+        self._tenants = OrderedDict()  # access token: _Tenant, LRU order
+        self._cache = OrderedDict()  # key: (expiry, value), LRU order
+        self._lock = threading.Lock()
+        self.counters = {'requests': 0, 'cache_hits': 0, 'cache_misses': 0,
+                         'evictions': 0}
+
+    def client(self, access_token):
+        """
+        Parameters
+        ----------
+        access_token : str
+
+        Returns
+        -------
+        PooledSmappee
+        """
+        with self._lock:
+            tenant = self._tenant(access_token)
+            if tenant.client is None:
+                tenant.client = PooledSmappee(
+                    access_token=access_token, pool=self,
+                    transport=_TenantTransport(self, access_token))
+            return tenant.client
+
+    def _tenant(self, access_token):
+        """
+        Get or (re-)register a tenant, and mark it as most recently used.
+        Must be called with the lock held.
+
+        Parameters
+        ----------
+        access_token : str
+
+        Returns
+        -------
+        _Tenant
+        """
+        tenant = self._tenants.get(access_token)
+        if tenant is None:
+            tenant = _Tenant(self.tenant_quota)
+            self._tenants[access_token] = tenant
+            self._evict()
+        else:
+            self._tenants.move_to_end(access_token)
+        tenant.last_used = time.time()
+        return tenant
+
+    def _evict(self):
+        """
+        Evict the least recently used idle tenants until there are at most
+        max_tenants. Tenants with requests waiting or in flight are kept.
+        """
+        excess = len(self._tenants) - self.max_tenants
+        if excess <= 0:
+            return
+        # never the most recent one, it is the tenant being registered
+        for token in list(self._tenants.keys())[:-1]:
+            if excess <= 0:
+                break
+            if self._tenants[token].active == 0:
+                self._drop(token)
+                excess -= 1
+
+    def _drop(self, token):
+        del self._tenants[token]
+        for key in [k for k in self._cache if k[0] == token]:
+            del self._cache[key]
+        self.counters['evictions'] += 1
+
+    def evict_idle(self, idle_time):
+        """
+        Evict tenants that haven't been used for a while
+
+        Parameters
+        ----------
+        idle_time : float
+            seconds
+
+        Returns
+        -------
+        int
+            number of evicted tenants
+        """
+        limit = time.time() - idle_time
+        with self._lock:
+            tokens = [token for token, tenant in self._tenants.items()
+                      if tenant.last_used < limit and tenant.active == 0]
+            for token in tokens:
+                self._drop(token)
+        return len(tokens)
+
+    @contextmanager
+    def _slot(self, access_token):
+        """
+        Take a slot of the tenant's quota, then of the pool's budget
+        """
+        start = time.time()
+        with self._lock:
+            tenant = self._tenant(access_token)
+            tenant.active += 1
+        try:
+            with self._tenant_slot(tenant, start):
+                yield
+        finally:
+            with self._lock:
+                tenant.active -= 1
+
+    @contextmanager
+    def _tenant_slot(self, tenant, start):
+        tenant.semaphore.acquire()
+        try:
+            self._budget.acquire()
+            try:
+                with self._lock:
+                    tenant.in_flight += 1
+                    tenant.requests += 1
+                    tenant.wait_time += time.time() - start
+                    tenant.last_used = time.time()
+                    self.counters['requests'] += 1
+                try:
+                    yield
+                finally:
+                    with self._lock:
+                        tenant.in_flight -= 1
+            finally:
+                self._budget.release()
+        finally:
+            tenant.semaphore.release()
+
+    def _cached(self, key, func):
+        """
+        Parameters
+        ----------
+        key : tuple
+            starts with the access token
+        func : callable
+            requests the value on a cache miss
+
+        Returns
+        -------
+        object
+        """
+        now = time.time()
+        with self._lock:
+            hit = self._cache.get(key)
+            if hit is not None and hit[0] > now:
+                self._cache.move_to_end(key)
+                self.counters['cache_hits'] += 1
+                return hit[1]
+            self.counters['cache_misses'] += 1
+        value = func()
+        with self._lock:
+            if key[0] not in self._tenants:
+                # evicted in the meantime
+                return value
+            self._cache[key] = (now + self.cache_ttl, value)
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return value
+
+    def status(self):
+        """
+        Returns
+        -------
+        dict
+            counters, number of tenants and requests in flight,
+            and per tenant (by position in LRU order, oldest first, to keep
+            access tokens out of logs) requests, in flight and wait time
+        """
+        with self._lock:
+            tenants = [{'requests': t.requests, 'in_flight': t.in_flight,
+                        'wait_time': t.wait_time}
+                       for t in self._tenants.values()]
+            d = dict(self.counters)
+        d['tenants'] = len(tenants)
+        d['in_flight'] = sum(t['in_flight'] for t in tenants)
+        d['per_tenant'] = tenants
+        return d
+
+    def close(self):
+        self.transport.close()
@@ -0,0 +1,271 @@
+"""
+Record and replay HTTP traffic, to profile and regression test offline
+
+RecordingTransport wraps a transport and appends every request/response
+pair to a gzipped JSON lines archive. ReplayTransport serves the responses
+from such an archive without network, at recorded speed or as fast as
+possible.
+
+    transport = RecordingTransport(RequestsTransport(), 'session.jsonl.gz')
+    s = Smappee(client_id, client_secret, transport=transport)
+    ...
+    transport.close()
+
+    s = SimpleSmappee('token', transport=ReplayTransport('session.jsonl.gz'))
+
+Secrets are not recorded: request headers are left out, and passwords,
+client secrets and tokens are redacted in request bodies and JSON
+responses, at any depth. Secrets in non-JSON responses or under other keys
+are recorded as they are.
+"""
+
+import base64
+import gzip
+import json
+import re
+import threading
+import time
+from collections import defaultdict, deque
+
+import requests
+
+from .transport import Transport
+
+REDACTED = 'REDACTED'
+SECRETS = ('password', 'client_secret', 'refresh_token', 'access_token',
+           'username')
+
+_ID_RE = re.compile(r'/\d+(?=/|$)')
+
+
+class ReplayMiss(KeyError):
+    """
+    Raised when a request is not in the archive
+    """
+    pass
+
+
+def url_template(url):
+    """
+    Parameters
+    ----------
+    url : str
+
+    Returns
+    -------
+    str
+        url with numeric path segments (ids) replaced by {}
+    """
+    return _ID_RE.sub('/{}', url.split('?')[0])
+
+
+def _redact(d):
+    """
+    Replace the values of secret keys, at any depth of dicts and lists
+    """
+    if isinstance(d, dict):
+        return {k: REDACTED if k in SECRETS else _redact(v)
+                for k, v in d.items()}
+    if isinstance(d, list):
+        return [_redact(v) for v in d]
+    return d
+
+
+def _request_key(method, url, params, data, json_body):
+    """
+    Returns
+    -------
+    str
+        identifies a request: method, url, params without None values and
+        the (redacted) body
+    """
+    if params is not None:
+        params = {k: v for k, v in params.items() if v is not None}
+    if isinstance(data, bytes):
+        data = data.decode('utf-8', 'replace')
+    if isinstance(data, str) and url.endswith('/logon'):
+        # the body of a LocalSmappee logon is the password
+        data = REDACTED
+    return json.dumps([method.lower(), url, params or None, _redact(data),
+                       _redact(json_body)], sort_keys=True, default=str)
+
+
+class RecordingTransport(Transport):
+    """
+    Transport that records every request/response pair of another transport
+    """
+    def __init__(self, transport, path):
+        """
+        Parameters
+        ----------
+        transport : Transport
+            does the actual requests
+        path : str
+            archive, gzipped JSON lines, appended to if it exists
+        """
+        self.transport = transport
+        self.path = path
+        self._file = gzip.open(path, 'at', encoding='utf-8')
+        self._lock = threading.Lock()
+
+    def request(self, method, url, params=None, data=None, json=None,
+                headers=None, timeout=None):
+        start = time.time()
+        r = self.transport.request(method, url, params=params, data=data,
+                                   json=json, headers=headers,
+                                   timeout=timeout)
+        elapsed = time.time() - start
+        content = r.content
+        try:
+            body = _redact(_json_loads(content))
+            content = _json_dumps(body).encode('utf-8')
+        except ValueError:
+            pass
+        try:
+            text, encoding = content.decode('utf-8'), 'utf-8'
+        except UnicodeDecodeError:
+            text = base64.b64encode(content).decode('ascii')
+            encoding = 'base64'
+        record = {
+            'key': _request_key(method, url, params, data, json),
+            'template': url_template(url),
+            'method': method.lower(),
+            'url': url,
+            'params': params,
+            'status': r.status_code,
+            'content_type': r.headers.get('Content-Type'),
+            'content': text,
+            'encoding': encoding,
+            'started': start,
+            'elapsed': elapsed
+        }
+        line = _json_dumps(record) + '\n'
+        with self._lock:
+            self._file.write(line)
+            # sync flush, so the archive is readable up to this record if
+            # the process dies without close()
+            self._file.flush()
+        return r
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+        self.transport.close()
+
+
+def _json_loads(content):
+    return json.loads(content.decode('utf-8'))
+
+
+def _json_dumps(o):
+    return json.dumps(o, separators=(',', ':'), default=str)
+
+
+class ReplayTransport(Transport):
+    """
+    Transport that serves responses from an archive made by
+    RecordingTransport.
+
+    Requests are matched on method, url, params and body. Identical requests
+    get the recorded responses in order, the last one is repeated when they
+    run out. With `match_template`, a request that isn't in the archive gets
+    a response of a request with the same method and url template
+    (eg. consumption of another time range).
+    """
+    def __init__(self, path, speed=None, match_template=False):
+        """
+        Parameters
+        ----------
+        path : str
+        speed : float, optional
+            None (default) serves responses as fast as possible,
+            1 at recorded speed, 2 twice as fast, ...
+        match_template : bool
+            default False
+        """
+        self.path = path
+        self.speed = speed
+        self.match_template = match_template
+        self._by_key = defaultdict(deque)
+        self._by_template = defaultdict(deque)
+        self._lock = threading.Lock()
+        self.counters = {'requests': 0, 'template_matches': 0, 'misses': 0}
+        for record in _read_archive(path):
+            self._by_key[record['key']].append(record)
+            self._by_template[(record['method'],
+                               record['template'])].append(record)
+
+    def _next(self, queue):
+        # keep the last response, so it can be served again
+        if len(queue) > 1:
+            return queue.popleft()
+        return queue[0]
+
+    def request(self, method, url, params=None, data=None, json=None,
+                headers=None, timeout=None):
+        key = _request_key(method, url, params, data, json)
+        with self._lock:
+            self.counters['requests'] += 1
+            if self._by_key.get(key):
+                record = self._next(self._by_key[key])
+            elif self.match_template and self._by_template.get(
+                    (method.lower(), url_template(url))):
+                self.counters['template_matches'] += 1
+                record = self._next(
+                    self._by_template[(method.lower(), url_template(url))])
+            else:
+                self.counters['misses'] += 1
+                raise ReplayMiss("No recorded response for {} {}".format(
+                    method.upper(), url))
+        if self.speed:
+            time.sleep(record['elapsed'] / self.speed)
+        return _to_response(record, url)
+
+
+def _read_archive(path):
+    """
+    Read the records of an archive. An archive of a process that died
+    without closing it lacks the gzip trailer and may end with a cut off
+    line, the records before that are still returned.
+
+    Parameters
+    ----------
+    path : str
+
+    Returns
+    -------
+    [dict]
+    """
+    records = []
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        try:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    # the last line may be cut off
+                    break
+        except EOFError:
+            pass
+    return records
+
+
+def _to_response(record, url):
+    """
+    Returns
+    -------
+    requests.Response
+    """
+    r = requests.Response()
+    r.status_code = record['status']
+    r.url = url
+    if record['content_type'] is not None:
+        r.headers['Content-Type'] = record['content_type']
+    if record['encoding'] == 'base64':
+        r._content = base64.b64decode(record['content'])
+    else:
+        r._content = record['content'].encode('utf-8')
+    r.encoding = 'utf-8'
+    return r
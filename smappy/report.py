@@ -0,0 +1,62 @@
+"""
+Parser for the text report of LocalSmappee.report_instantaneous_values
+
+The gateway returns something like
+{"report": "Instantaneous values:<BR>voltage=230.1 Vrms<BR>...
+Phase 1:<BR>&nbsp;&nbsp;current=1.057 A, activePower=178.000 W,
+reactivePower=165.000 var, apparentPower=243.000 VA, cosfi=73, ...<BR>
+Phase 2:<BR>..."}
+
+The report is scanned once with a precompiled pattern, values before the
+first phase header are global, the others belong to their phase.
+The raw response bytes can be parsed directly, without decoding the JSON.
+"""
+
+import re
+
+FIELDS = ('voltage', 'current', 'activePower', 'reactivePower',
+          'apparentPower', 'cosfi', 'frequency')
+
+_PATTERN = r'Phase (\d+)|\b({})=(-?\d+(?:\.\d+)?)'.format('|'.join(FIELDS))
+_STR_RE = re.compile(_PATTERN)
+_BYTES_RE = re.compile(_PATTERN.encode('ascii'))
+
+# decoded field names, so we don't decode them for every match
+_BYTES_FIELDS = {f.encode('ascii'): f for f in FIELDS}
+
+
+def parse_instantaneous_report(report):
+    """
+    Parse a reportInstantaneousValues report
+
+    Parameters
+    ----------
+    report : bytes | str | dict
+        the raw response body (bytes), the report text (str) or the dict
+        returned by LocalSmappee.report_instantaneous_values
+
+    Returns
+    -------
+    dict
+        global values (eg. 'voltage', 'frequency') as floats, and
+        'phases': {phase number (int): {field: float}}
+    """
+    if isinstance(report, dict):
+        report = report['report']
+    if isinstance(report, (bytes, bytearray)):
+        regex = _BYTES_RE
+        names = _BYTES_FIELDS
+    else:
+        regex = _STR_RE
+        names = None
+
+    result = {'phases': {}}
+    current = result
+    for phase, field, value in regex.findall(report):
+        if phase:
+            current = result['phases'].setdefault(int(phase), {})
+            continue
+        if names is not None:
+            field = names[field]
+        current[field] = float(value)
+    return result
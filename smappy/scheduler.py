@@ -0,0 +1,187 @@
+"""
+Priority scheduling of requests over a shared transport
+
+PriorityTransport wraps a transport and limits the number of requests in
+flight. Waiting requests are queued per priority class (control,
+interactive, bulk) and the highest class always goes first. Bulk requests
+can only use part of the slots, so control and interactive requests find
+a free slot quickly, even during a large backfill.
+
+    transport = PriorityTransport(max_concurrency=8, bulk_concurrency=6)
+    s = Smappee(client_id, client_secret, transport=transport)
+    with priority(BULK):
+        s.get_consumption(...)  # backfill
+    s.actuator_on(...)  # control, goes before all queued bulk requests
+"""
+
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from .transport import Transport, RequestsTransport
+
+CONTROL = 'control'
+INTERACTIVE = 'interactive'
+BULK = 'bulk'
+PRIORITIES = (CONTROL, INTERACTIVE, BULK)  # highest first
+
+_local = threading.local()
+
+
+class QueueFull(Exception):
+    """
+    Raised when the queue of a priority class is full
+    """
+    pass
+
+
+@contextmanager
+def priority(klass):
+    """
+    Context manager setting the priority class of the requests made in it,
+    by the current thread
+
+    Parameters
+    ----------
+    klass : str
+        CONTROL, INTERACTIVE or BULK
+    """
+    if klass not in PRIORITIES:
+        raise ValueError("Priority must be one of {}".format(PRIORITIES))
+    previous = getattr(_local, 'priority', None)
+    _local.priority = klass
+    try:
+        yield
+    finally:
+        _local.priority = previous
+
+
+class PriorityTransport(Transport):
+    """
+    Transport that schedules requests by priority class.
+
+    Requests without a priority class (see `priority`) are CONTROL if they
+    go to an actuator, else `default`.
+    """
+    def __init__(self, transport=None, max_concurrency=8,
+                 bulk_concurrency=None, queue_sizes=None,
+                 default=INTERACTIVE):
+        """
+        Parameters
+        ----------
+        transport : Transport, optional
+            default RequestsTransport
+        max_concurrency : int
+            default 8, requests in flight
+        bulk_concurrency : int, optional
+            bulk requests in flight, default max_concurrency - 2
+            (at least 1), keeping slots free for the other classes
+        queue_sizes : dict, optional
+            {class: max queued requests},
+            default 100 control, 1000 interactive and 10000 bulk
+        default : str
+            default INTERACTIVE
+        """
+        if transport is None:
+            transport = RequestsTransport()
+        if bulk_concurrency is None:
+            bulk_concurrency = max(1, max_concurrency - 2)
+        self.transport = transport
+        self.max_concurrency = max_concurrency
+        self.bulk_concurrency = bulk_concurrency
+        self.queue_sizes = {CONTROL: 100, INTERACTIVE: 1000, BULK: 10000}
+        if queue_sizes is not None:
+            self.queue_sizes.update(queue_sizes)
+        self.default = default
+
+        self._cond = threading.Condition()
+        self._queues = {p: deque() for p in PRIORITIES}
+        self._running = {p: 0 for p in PRIORITIES}
+        self._stats = {p: {'requests': 0, 'rejected': 0, 'wait_total': 0.,
+                           'wait_max': 0.} for p in PRIORITIES}
+
+    def _classify(self, method, url):
+        klass = getattr(_local, 'priority', None)
+        if klass is not None:
+            return klass
+        if method.lower() == 'post' and '/actuator/' in url:
+            return CONTROL
+        return self.default
+
+    def _can_run(self, klass):
+        if sum(self._running.values()) >= self.max_concurrency:
+            return False
+        if klass == BULK and self._running[BULK] >= self.bulk_concurrency:
+            return False
+        return True
+
+    def _is_next(self, klass, ticket):
+        """
+        A ticket is next if it is first in its queue and no higher class
+        is waiting
+        """
+        for p in PRIORITIES:
+            if p == klass:
+                return self._queues[p][0] is ticket
+            if self._queues[p]:
+                return False
+
+    def _acquire(self, klass):
+        ticket = object()
+        start = time.time()
+        with self._cond:
+            queue = self._queues[klass]
+            if len(queue) >= self.queue_sizes[klass]:
+                self._stats[klass]['rejected'] += 1
+                raise QueueFull("Queue of {} requests is full".format(klass))
+            queue.append(ticket)
+            try:
+                while not (self._is_next(klass, ticket) and
+                           self._can_run(klass)):
+                    self._cond.wait()
+            finally:
+                queue.remove(ticket)
+                # the next ticket may be able to run too
+                self._cond.notify_all()
+            self._running[klass] += 1
+            wait = time.time() - start
+            stats = self._stats[klass]
+            stats['requests'] += 1
+            stats['wait_total'] += wait
+            stats['wait_max'] = max(stats['wait_max'], wait)
+
+    def _release(self, klass):
+        with self._cond:
+            self._running[klass] -= 1
+            self._cond.notify_all()
+
+    def request(self, method, url, **kwargs):
+        klass = self._classify(method, url)
+        self._acquire(klass)
+        try:
+            return self.transport.request(method, url, **kwargs)
+        finally:
+            self._release(klass)
+
+    def status(self):
+        """
+        Returns
+        -------
+        dict
+            per class: queued, running, requests, rejected and the total,
+            mean and max time waited in the queue (seconds)
+        """
+        with self._cond:
+            d = {}
+            for p in PRIORITIES:
+                stats = dict(self._stats[p])
+                stats['queued'] = len(self._queues[p])
+                stats['running'] = self._running[p]
+                stats['wait_mean'] = stats['wait_total'] / stats['requests'] \
+                    if stats['requests'] else 0.
+                d[p] = stats
+        return d
+
+    def close(self):
+        self.transport.close()
@@ -3,6 +3,11 @@ import datetime as dt
 from functools import wraps
 import pytz
 import numbers
+import time
+
+from .health import GatewayHealth
+from .report import parse_instantaneous_report
+from .transport import RequestsTransport
 
 __title__ = "smappy"
 __version__ = "0.2.16"
@@ -14,6 +19,13 @@ URLS = {
     'servicelocation': 'https://app1pub.smappee.net/dev/v2/servicelocation'
 }
 
+# length of a block in seconds, per aggregation
+BLOCK_SECONDS = {
+    1: 5 * 60,
+    2: 60 * 60,
+    3: 24 * 60 * 60
+}
+
 
 def authenticated(func):
     """
@@ -35,7 +47,8 @@ class Smappee(object):
     Object containing Smappee's API-methods.
     See https://smappee.atlassian.net/wiki/display/DEVAPI/API+Methods
     """
-    def __init__(self, client_id=None, client_secret=None):
+    def __init__(self, client_id=None, client_secret=None, token_store=None,
+                 transport=None):
         """
         To receive a client id and secret,
         you need to request via the Smappee support
@@ -47,12 +60,28 @@ class Smappee(object):
             If None, you won't be able to do any authorisation,
             so it requires that you already have an access token somewhere.
             In that case, the SimpleSmappee class is something for you.
-        """
+        token_store : TokenStore, optional
+            Share the tokens with other Smappee objects and processes,
+            eg. FileTokenStore or SqliteTokenStore.
+            Only one of them authenticates, the others pick up its token.
+        transport : Transport, optional
+            does the HTTP requests, default RequestsTransport.
+            Use HTTPXTransport to multiplex concurrent requests over
+            a single HTTP/2 connection.
+        """
+        if transport is None:
+            transport = RequestsTransport()
+        self.transport = transport
         self.client_id = client_id
         self.client_secret = client_secret
+        self.token_store = token_store
         self.access_token = None
         self.refresh_token = None
         self.token_expiration_time = None
+        if token_store is not None:
+            token = token_store.load()
+            if token is not None:
+                self._set_token(token)
 
     def authenticate(self, username, password):
         """
@@ -66,12 +95,27 @@ class Smappee(object):
 
         Returns
         -------
-        requests.Response
+        requests.Response | None
             access token is saved in self.access_token
             refresh token is saved in self.refresh_token
             expiration time is set in self.token_expiration_time as
             datetime.datetime
-        """
+            None if a valid token was found in the token store,
+            in which case no request is made
+        """
+        if self.token_store is None:
+            return self._authenticate(username=username, password=password)
+        with self.token_store.lock():
+            token = self.token_store.load()
+            if token is not None and \
+               token['token_expiration_time'] > dt.datetime.utcnow():
+                self._set_token(token)
+                return None
+            r = self._authenticate(username=username, password=password)
+            self.token_store.save(self._get_token())
+        return r
+
+    def _authenticate(self, username, password):
         url = URLS['token']
         data = {
             "grant_type": "password",
@@ -80,7 +124,7 @@ class Smappee(object):
             "username": username,
             "password": password
         }
-        r = requests.post(url, data=data)
+        r = self.transport.request('post', url, data=data)
         r.raise_for_status()
         j = r.json()
         self.access_token = j['access_token']
@@ -88,6 +132,30 @@ class Smappee(object):
         self._set_token_expiration_time(expires_in=j['expires_in'])
         return r
 
+    def _get_token(self):
+        """
+        Returns
+        -------
+        dict
+            the current tokens, in the format used by the token store
+        """
+        return {
+            'access_token': self.access_token,
+            'refresh_token': self.refresh_token,
+            'token_expiration_time': self.token_expiration_time
+        }
+
+    def _set_token(self, token):
+        """
+        Parameters
+        ----------
+        token : dict
+            tokens in the format used by the token store
+        """
+        self.access_token = token['access_token']
+        self.refresh_token = token['refresh_token']
+        self.token_expiration_time = token['token_expiration_time']
+
     def _set_token_expiration_time(self, expires_in):
         """
         Saves the token expiration time by adding the 'expires in' parameter
@@ -114,12 +182,30 @@ class Smappee(object):
 
         Returns
         -------
-        requests.Response
+        requests.Response | None
             access token is saved in self.access_token
             refresh token is saved in self.refresh_token
             expiration time is set in self.token_expiration_time as
             datetime.datetime
-        """
+            None if another process already refreshed the token in the
+            token store, in which case no request is made
+        """
+        if self.token_store is None:
+            return self._re_authenticate()
+        with self.token_store.lock():
+            token = self.token_store.load()
+            if token is not None and \
+               token['token_expiration_time'] > dt.datetime.utcnow():
+                self._set_token(token)
+                return None
+            if token is not None:
+                # the stored refresh token is the most recent one
+                self.refresh_token = token['refresh_token']
+            r = self._re_authenticate()
+            self.token_store.save(self._get_token())
+        return r
+
+    def _re_authenticate(self):
         url = URLS['token']
         data = {
             "grant_type": "refresh_token",
@@ -127,7 +213,7 @@ class Smappee(object):
             "client_id": self.client_id,
             "client_secret": self.client_secret
         }
-        r = requests.post(url, data=data)
+        r = self.transport.request('post', url, data=data)
         r.raise_for_status()
         j = r.json()
         self.access_token = j['access_token']
@@ -146,7 +232,7 @@ class Smappee(object):
         """
         url = URLS['servicelocation']
         headers = {"Authorization": "Bearer {}".format(self.access_token)}
-        r = requests.get(url, headers=headers)
+        r = self.transport.request('get', url, headers=headers)
         r.raise_for_status()
         return r.json()
 
@@ -165,7 +251,7 @@ class Smappee(object):
         """
         url = urljoin(URLS['servicelocation'], service_location_id, "info")
         headers = {"Authorization": "Bearer {}".format(self.access_token)}
-        r = requests.get(url, headers=headers)
+        r = self.transport.request('get', url, headers=headers)
         r.raise_for_status()
         return r.json()
 
@@ -268,7 +354,7 @@ class Smappee(object):
             "from": start,
             "to": end
         }
-        r = requests.get(url, headers=headers, params=params)
+        r = self.transport.request('get', url, headers=headers, params=params)
         r.raise_for_status()
         return r.json()
 
@@ -306,7 +392,7 @@ class Smappee(object):
             "applianceId": appliance_id,
             "maxNumber": max_number
         }
-        r = requests.get(url, headers=headers, params=params)
+        r = self.transport.request('get', url, headers=headers, params=params)
         r.raise_for_status()
         return r.json()
 
@@ -381,7 +467,7 @@ class Smappee(object):
             data = {"duration": duration}
         else:
             data = {}
-        r = requests.post(url, headers=headers, json=data)
+        r = self.transport.request('post', url, headers=headers, json=data)
         r.raise_for_status()
         return r
 
@@ -449,6 +535,80 @@ class Smappee(object):
                 df = df.tz_convert(timezone)
         return df
 
+    def follow_consumption(self, service_location_id, aggregation=1,
+                           start=None, publish_delay=60, raw=False):
+        """
+        Generator that follows the consumption of a service location in near
+        real time. Only the blocks after the last one seen are requested, the
+        last block is requested again until it is final.
+        Polling is aligned to the moments the server publishes a new block.
+
+        Parameters
+        ----------
+        service_location_id : int
+        aggregation : int
+            1 = 5 min values (default)
+            2 = hourly values
+            3 = daily values
+        start : int | dt.datetime | pd.Timestamp, optional
+            start and end support epoch (in milliseconds),
+            datetime and Pandas Timestamp
+            default: the start of the current block
+        publish_delay : int
+            default 60
+            seconds after the end of a block before the server has
+            published it. Until then the block is considered open.
+        raw : bool
+            default False, see get_consumption
+
+        Yields
+        ------
+        dict
+            every new record, and every open record whose values changed
+        """
+        if aggregation not in BLOCK_SECONDS:
+            raise ValueError("Follow mode supports aggregation {}".format(
+                sorted(BLOCK_SECONDS.keys())))
+        block = BLOCK_SECONDS[aggregation] * 1000
+        delay = publish_delay * 1000
+
+        now = self._to_milliseconds(dt.datetime.utcnow())
+        if start is None:
+            start = now - now % block
+        frm = self._to_milliseconds(start)
+        seen = {}  # timestamp: record, for blocks that are still open
+
+        while True:
+            d = self.get_consumption(
+                service_location_id=service_location_id, start=frm, end=now,
+                aggregation=aggregation, raw=raw)
+            records = sorted(d['consumptions'], key=lambda r: r['timestamp'])
+            for record in records:
+                ts = record['timestamp']
+                if ts < frm:
+                    continue
+                if seen.get(ts) != record:
+                    seen[ts] = record
+                    yield record
+
+            # a block is final if the server had published it when we
+            # requested it, start the next request at the oldest open block
+            for ts in sorted(seen.keys()):
+                if ts + block + delay <= now:
+                    del seen[ts]
+                    frm = max(frm, ts + block)
+            if seen:
+                frm = min(seen.keys())
+
+            # sleep until the next block gets published
+            now = self._to_milliseconds(dt.datetime.utcnow())
+            next_publish = now - now % block + block + delay
+            if next_publish - block > now:
+                # the previous block is not published yet
+                next_publish -= block
+            time.sleep((next_publish - now) / 1e3)
+            now = self._to_milliseconds(dt.datetime.utcnow())
+
     def _to_milliseconds(self, time):
         """
         Converts a datetime-like object to epoch, in milliseconds
@@ -463,15 +623,7 @@ class Smappee(object):
         int
             epoch milliseconds
         """
-        if isinstance(time, dt.datetime):
-            if time.tzinfo is None:
-                time = time.replace(tzinfo=pytz.UTC)
-            return int(time.timestamp() * 1e3)
-        elif isinstance(time, numbers.Number):
-            return time
-        else:
-            raise NotImplementedError("Time format not supported. Use milliseconds since epoch,\
-                                        Datetime or Pandas Datetime")
+        return to_milliseconds(time)
 
 
 class SimpleSmappee(Smappee):
@@ -483,13 +635,16 @@ class SimpleSmappee(Smappee):
     It has no means of refreshing it when it expires, in which case
     the requests will return errors.
     """
-    def __init__(self, access_token):
+    def __init__(self, access_token, transport=None):
         """
         Parameters
         ----------
         access_token : str
+        transport : Transport, optional
+            default RequestsTransport
         """
-        super(SimpleSmappee, self).__init__(client_id=None, client_secret=None)
+        super(SimpleSmappee, self).__init__(client_id=None, client_secret=None,
+                                            transport=transport)
         self.access_token = access_token
 
 
@@ -497,23 +652,44 @@ class LocalSmappee(object):
     """
     Access a Smappee in your local network
     """
-    def __init__(self, ip):
+    # fixed timeout of slow administrative calls (restart, resets, logs),
+    # they don't use the adaptive timeout of the frequent polls
+    ADMIN_TIMEOUT = 5
+
+    def __init__(self, ip, health=None, transport=None):
         """
         Parameters
         ----------
         ip : str
             local IP-address of your Smappee
+        health : GatewayHealth, optional
+            tracks latency and failures of the gateway, sets the timeouts
+            and fails fast while the gateway is down.
+            Default: a GatewayHealth with default settings.
+            If it has no probe, the gateway is probed in the background
+            with a GET on its base url.
+        transport : Transport, optional
+            does the HTTP requests, default RequestsTransport
         """
         self.ip = ip
         self.headers = {'Content-Type': 'application/json;charset=UTF-8'}
-        self.session = requests.Session()
+        if transport is None:
+            transport = RequestsTransport()
+        self.transport = transport
+        # kept for backwards compatibility, None for other transports
+        self.session = getattr(transport, 'session', None)
+        if health is None:
+            health = GatewayHealth()
+        if health.probe is None:
+            health.probe = self._probe
+        self.health = health
 
     @property
     def base_url(self):
         url = urljoin('http://', self.ip, 'gateway', 'apipublic')
         return url
 
-    def _basic_post(self, url, data=None):
+    def _basic_post(self, url, data=None, timeout=None):
         """
         Because basically every post request is the same
 
@@ -521,23 +697,92 @@ class LocalSmappee(object):
         ----------
         url : str
         data : str, optional
+        timeout : float, optional
+            see _request
 
         Returns
         -------
         requests.Response
         """
         _url = urljoin(self.base_url, url)
-        r = self.session.post(_url, data=data, headers=self.headers, timeout=5)
+        r = self._request('post', _url, data=data, headers=self.headers,
+                          timeout=timeout)
         r.raise_for_status()
         return r
 
-    def _basic_get(self, url, params=None):
+    def _basic_get(self, url, params=None, timeout=None):
         _url = urljoin(self.base_url, url)
-        r = self.session.get(_url, params=params, headers=self.headers,
-                             timeout=5)
+        r = self._request('get', _url, params=params, headers=self.headers,
+                          timeout=timeout)
         r.raise_for_status()
         return r
 
+    def _request(self, method, url, timeout=None, **kwargs):
+        """
+        Make a request with a timeout set by self.health,
+        and report its outcome.
+        Only connection errors and timeouts count as failures,
+        an HTTP error status means the gateway is up.
+
+        Parameters
+        ----------
+        method : str
+        url : str
+        timeout : float, optional
+            fixed timeout for slow calls, instead of the adaptive one.
+            Their latency is not tracked, and running into this timeout
+            does not count as a failure of the gateway
+            (failing to connect still does).
+        kwargs
+            passed to requests
+
+        Returns
+        -------
+        requests.Response
+
+        Raises
+        ------
+        GatewayUnavailable
+            if the gateway is known to be down
+        """
+        self.health.before_request()
+        fixed = timeout is not None
+        if not fixed:
+            timeout = self.health.timeout()
+        start = time.monotonic()
+        try:
+            r = self.transport.request(method, url, timeout=timeout, **kwargs)
+        except requests.exceptions.ConnectTimeout:
+            self.health.record_failure()
+            raise
+        except requests.exceptions.Timeout:
+            if not fixed:
+                self.health.record_failure()
+            raise
+        except requests.exceptions.ConnectionError:
+            self.health.record_failure()
+            raise
+        self.health.record_success(
+            None if fixed else time.monotonic() - start)
+        return r
+
+    def _probe(self):
+        """
+        Used by self.health to check if the gateway is back up
+        """
+        self.transport.request('get', self.base_url,
+                               timeout=self.health.max_timeout)
+
+    def health_status(self):
+        """
+        Returns
+        -------
+        dict
+            state of the circuit ('closed', 'open' or 'half_open'),
+            current timeout, latency percentiles and request counters
+        """
+        return self.health.status()
+
     def logon(self, password='admin'):
         """
         Parameters
@@ -561,6 +806,22 @@ class LocalSmappee(object):
         r = self._basic_get(url='reportInstantaneousValues')
         return r.json()
 
+    def instantaneous_values(self):
+        """
+        Requests the instantaneous values report and parses it,
+        straight from the response bytes
+
+        Returns
+        -------
+        dict
+            global values (eg. 'voltage', 'frequency') as floats, and
+            'phases': {phase number (int): {field: float}}
+            with fields 'current', 'activePower', 'reactivePower',
+            'apparentPower', 'cosfi' (as far as reported by the gateway)
+        """
+        r = self._basic_get(url='reportInstantaneousValues')
+        return parse_instantaneous_report(r.content)
+
     def load_instantaneous(self):
         """
         Returns
@@ -601,7 +862,8 @@ class LocalSmappee(object):
         -------
         requests.Response
         """
-        return self._basic_get(url='restartSmappee?action=2')
+        return self._basic_get(url='restartSmappee?action=2',
+                               timeout=self.ADMIN_TIMEOUT)
 
     def reset_active_power_peaks(self):
         """
@@ -609,7 +871,8 @@ class LocalSmappee(object):
         -------
         requests.Response
         """
-        return self._basic_post(url='resetActivePowerPeaks')
+        return self._basic_post(url='resetActivePowerPeaks',
+                                timeout=self.ADMIN_TIMEOUT)
 
     def reset_ip_scan_cache(self):
         """
@@ -617,7 +880,8 @@ class LocalSmappee(object):
         -------
         requests.Response
         """
-        return self._basic_post(url='resetIPScanCache')
+        return self._basic_post(url='resetIPScanCache',
+                                timeout=self.ADMIN_TIMEOUT)
 
     def reset_sensor_cache(self):
         """
@@ -625,7 +889,8 @@ class LocalSmappee(object):
         -------
         requests.Response
         """
-        return self._basic_post(url='resetSensorCache')
+        return self._basic_post(url='resetSensorCache',
+                                timeout=self.ADMIN_TIMEOUT)
 
     def reset_data(self):
         """
@@ -633,7 +898,8 @@ class LocalSmappee(object):
         -------
         requests.Response
         """
-        return self._basic_post(url='clearData')
+        return self._basic_post(url='clearData',
+                                timeout=self.ADMIN_TIMEOUT)
 
     def clear_appliances(self):
         """
@@ -641,7 +907,8 @@ class LocalSmappee(object):
         -------
         requests.Response
         """
-        return self._basic_post(url='clearAppliances')
+        return self._basic_post(url='clearAppliances',
+                                timeout=self.ADMIN_TIMEOUT)
 
     def load_advanced_config(self):
         """
@@ -785,7 +1052,8 @@ class LocalSmappee(object):
         -------
         dict
         """
-        r = self._basic_post(url='logBrowser', data='logFileList')
+        r = self._basic_post(url='logBrowser', data='logFileList',
+                             timeout=self.ADMIN_TIMEOUT)
         return r.json()
 
     def select_logfile(self, logfile):
@@ -799,7 +1067,8 @@ class LocalSmappee(object):
         dict
         """
         data = 'logFileSelect,' + logfile
-        r = self._basic_post(url='logBrowser', data=data)
+        r = self._basic_post(url='logBrowser', data=data,
+                             timeout=self.ADMIN_TIMEOUT)
         return r.json()
 
 
@@ -828,3 +1097,28 @@ def urljoin(*parts):
     # join everything together
     url = '/'.join(part_list)
     return url
+
+
+def to_milliseconds(time):
+    """
+    Converts a datetime-like object to epoch, in milliseconds
+    Timezone-naive datetime objects are assumed to be in UTC
+
+    Parameters
+    ----------
+    time : dt.datetime | pd.Timestamp | int
+
+    Returns
+    -------
+    int
+        epoch milliseconds
+    """
+    if isinstance(time, dt.datetime):
+        if time.tzinfo is None:
+            time = time.replace(tzinfo=pytz.UTC)
+        return int(time.timestamp() * 1e3)
+    elif isinstance(time, numbers.Number):
+        return time
+    else:
+        raise NotImplementedError("Time format not supported. Use milliseconds since epoch,\
+                                    Datetime or Pandas Datetime")
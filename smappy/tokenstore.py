@@ -0,0 +1,237 @@
+import datetime as dt
+import json
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+EPOCH = dt.datetime(1970, 1, 1)
+
+
+class TokenStore(object):
+    """
+    Base class for a token store that can be shared by several Smappee
+    objects, possibly living in different processes on the same host.
+
+    A token is a dict with the keys 'access_token', 'refresh_token' and
+    'token_expiration_time' (a timezone-naive datetime in UTC).
+
+    Subclasses implement `load`, `save` and `lock`. Smappee only calls `load`
+    and `save` while holding the lock, so that only one process at a time
+    authenticates or refreshes.
+    """
+    def load(self):
+        """
+        Returns
+        -------
+        dict | None
+            the stored token, None if nothing has been stored yet
+        """
+        raise NotImplementedError
+
+    def save(self, token):
+        """
+        Parameters
+        ----------
+        token : dict
+        """
+        raise NotImplementedError
+
+    @contextmanager
+    def lock(self):
+        """
+        Context manager holding an exclusive, cross-process lock on the store
+        """
+        raise NotImplementedError
+        yield
+
+    def clear(self):
+        """
+        Remove the stored token
+        """
+        raise NotImplementedError
+
+
+def _serialize(token):
+    """
+    Parameters
+    ----------
+    token : dict
+
+    Returns
+    -------
+    dict
+        token with the expiration time as epoch seconds
+    """
+    expiration = token['token_expiration_time']
+    return {
+        'access_token': token['access_token'],
+        'refresh_token': token['refresh_token'],
+        'token_expiration_time': (expiration - EPOCH).total_seconds()
+    }
+
+
+def _deserialize(d):
+    """
+    Parameters
+    ----------
+    d : dict
+        token with the expiration time as epoch seconds
+
+    Returns
+    -------
+    dict
+    """
+    expiration = EPOCH + dt.timedelta(seconds=d['token_expiration_time'])
+    return {
+        'access_token': d['access_token'],
+        'refresh_token': d['refresh_token'],
+        'token_expiration_time': expiration
+    }
+
+
+class FileTokenStore(TokenStore):
+    """
+    Stores the token as JSON in a file, guarded by an flock on a separate
+    lock file (POSIX only, use SqliteTokenStore on Windows)
+    """
+    def __init__(self, path):
+        """
+        Parameters
+        ----------
+        path : str
+            the lock file is created next to it, as path + '.lock'
+        """
+        if fcntl is None:
+            raise NotImplementedError("FileTokenStore needs fcntl, "
+                                      "use SqliteTokenStore on this platform")
+        self.path = path
+        self.lock_path = path + '.lock'
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as f:
+                d = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        return _deserialize(d)
+
+    def save(self, token):
+        # write to a temporary file and rename, so a reader never sees a
+        # half written file. Only the owner may read the refresh token.
+        tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(_serialize(token), f)
+        os.replace(tmp_path, self.path)
+
+    @contextmanager
+    def lock(self):
+        fd = os.open(self.lock_path, os.O_WRONLY | os.O_CREAT, 0o600)
+        with os.fdopen(fd, 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def clear(self):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+class SqliteTokenStore(TokenStore):
+    """
+    Stores tokens in a SQLite database, one row per key, so several
+    accounts can share one database file
+    """
+    def __init__(self, path, key='default'):
+        """
+        Parameters
+        ----------
+        path : str
+        key : str
+            default 'default'
+            use a different key per Smappee account
+        """
+        self.path = path
+        self.key = key
+        # the connection of the lock() a thread is in, if any
+        self._local = threading.local()
+        if not os.path.exists(path):
+            # create the file ourselves, only the owner may read the tokens
+            os.close(os.open(path, os.O_WRONLY | os.O_CREAT, 0o600))
+        with self._connection() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS tokens ("
+                         "key TEXT PRIMARY KEY, "
+                         "access_token TEXT, "
+                         "refresh_token TEXT, "
+                         "token_expiration_time REAL)")
+            conn.commit()
+
+    @property
+    def _conn(self):
+        return getattr(self._local, 'conn', None)
+
+    @contextmanager
+    def _connection(self):
+        if self._conn is not None:
+            # this thread is inside lock(), reuse its transaction
+            yield self._conn
+            return
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def load(self):
+        with self._connection() as conn:
+            row = conn.execute("SELECT access_token, refresh_token, "
+                               "token_expiration_time FROM tokens "
+                               "WHERE key = ?", (self.key,)).fetchone()
+        if row is None:
+            return None
+        return _deserialize(dict(zip(['access_token', 'refresh_token',
+                                      'token_expiration_time'], row)))
+
+    def save(self, token):
+        d = _serialize(token)
+        with self._connection() as conn:
+            conn.execute("INSERT OR REPLACE INTO tokens VALUES (?, ?, ?, ?)",
+                         (self.key, d['access_token'], d['refresh_token'],
+                          d['token_expiration_time']))
+            if conn is not self._conn:
+                conn.commit()
+
+    @contextmanager
+    def lock(self):
+        # BEGIN IMMEDIATE takes the database write lock, other processes
+        # block on it until we commit
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            self._local.conn = conn
+            try:
+                yield
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            else:
+                conn.execute("COMMIT")
+        finally:
+            self._local.conn = None
+            conn.close()
+
+    def clear(self):
+        with self._connection() as conn:
+            conn.execute("DELETE FROM tokens WHERE key = ?", (self.key,))
+            if conn is not self._conn:
+                conn.commit()
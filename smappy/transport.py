@@ -0,0 +1,166 @@
+"""
+Transports do the HTTP I/O for Smappee, SimpleSmappee and LocalSmappee.
+
+RequestsTransport (default) uses a requests Session, HTTPXTransport uses an
+httpx Client, which can multiplex many concurrent requests over a single
+HTTP/2 connection.
+
+A transport has one method, request(method, url, **kwargs), returning an
+object that behaves like a requests.Response (status_code, content, text,
+headers, json() and raise_for_status()). Errors are raised as requests
+exceptions, whatever the backend.
+"""
+
+import json as _json
+
+import requests
+
+
+class Transport(object):
+    """
+    Base class for transports
+    """
+    def request(self, method, url, params=None, data=None, json=None,
+                headers=None, timeout=None):
+        """
+        Parameters
+        ----------
+        method : str
+            'get' or 'post'
+        url : str
+        params : dict, optional
+            query parameters, None values are left out
+        data : dict | str, optional
+            form data or raw body
+        json : dict, optional
+            JSON body
+        headers : dict, optional
+        timeout : float, optional
+            seconds
+
+        Returns
+        -------
+        requests.Response or an object that behaves like it
+        """
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class RequestsTransport(Transport):
+    """
+    Transport using a requests Session, so connections are kept alive
+    and reused (HTTP/1.1)
+    """
+    def __init__(self, session=None):
+        """
+        Parameters
+        ----------
+        session : requests.Session, optional
+        """
+        if session is None:
+            session = requests.Session()
+        self.session = session
+
+    def request(self, method, url, params=None, data=None, json=None,
+                headers=None, timeout=None):
+        return self.session.request(method, url, params=params, data=data,
+                                    json=json, headers=headers,
+                                    timeout=timeout)
+
+    def close(self):
+        self.session.close()
+
+
+class HTTPXResponse(object):
+    """
+    Wraps an httpx.Response so it behaves like a requests.Response
+    """
+    def __init__(self, response):
+        self._response = response
+        self.status_code = response.status_code
+        self.headers = response.headers
+        self.content = response.content
+        self.url = str(response.url)
+        self.http_version = response.http_version
+
+    @property
+    def text(self):
+        return self._response.text
+
+    @property
+    def reason(self):
+        return self._response.reason_phrase
+
+    def json(self):
+        return _json.loads(self.content)
+
+    def raise_for_status(self):
+        if 400 <= self.status_code < 600:
+            kind = 'Client' if self.status_code < 500 else 'Server'
+            raise requests.exceptions.HTTPError(
+                "{} {} Error: {} for url: {}".format(
+                    self.status_code, kind, self.reason, self.url),
+                response=self)
+
+
+class HTTPXTransport(Transport):
+    """
+    Transport using an httpx Client. With http2=True (default, requires
+    `pip install httpx[http2]`) concurrent requests to the same host, eg.
+    from a thread pool, share one multiplexed connection.
+
+    A request with a timeout uses it. A request without one (all Smappee
+    and SimpleSmappee requests) uses the `timeout` of the client: like
+    RequestsTransport that is no timeout at all, unless you pass a timeout
+    in client_kwargs. httpx's own default of 5 seconds is not used.
+    """
+    def __init__(self, http2=True, **client_kwargs):
+        """
+        Parameters
+        ----------
+        http2 : bool
+            default True
+        client_kwargs
+            passed to httpx.Client, eg. limits, verify or timeout
+            (default None: no timeout)
+        """
+        try:
+            import httpx
+        except ImportError:
+            raise ImportError("HTTPXTransport requires httpx, install it "
+                              "with `pip install httpx[http2]`")
+        self._httpx = httpx
+        # requests has no default timeout, don't let httpx add one
+        client_kwargs.setdefault('timeout', None)
+        self.client = httpx.Client(http2=http2, **client_kwargs)
+
+    def request(self, method, url, params=None, data=None, json=None,
+                headers=None, timeout=None):
+        httpx = self._httpx
+        if params is not None:
+            # requests leaves out None values, httpx doesn't
+            params = {k: v for k, v in params.items() if v is not None}
+        kwargs = {}
+        if isinstance(data, (str, bytes)):
+            kwargs['content'] = data
+        elif data is not None:
+            kwargs['data'] = data
+        if json is not None:
+            kwargs['json'] = json
+        if timeout is not None:
+            kwargs['timeout'] = timeout
+        try:
+            r = self.client.request(method.upper(), url, params=params,
+                                    headers=headers, **kwargs)
+        except httpx.ConnectTimeout as e:
+            raise requests.exceptions.ConnectTimeout(str(e))
+        except httpx.TimeoutException as e:
+            raise requests.exceptions.Timeout(str(e))
+        except httpx.TransportError as e:
+            raise requests.exceptions.ConnectionError(str(e))
+        return HTTPXResponse(r)
+
+    def close(self):
+        self.client.close()
@@ -0,0 +1,215 @@
+"""
+Appliance usage (runtime, cycles, energy) from the events of get_events
+
+An event with a positive activePower switches an appliance on, a negative one
+switches it off. On and off events are paired with vectorized NumPy
+operations:
+
+- repeated events in the same state (on, on) are collapsed to the first one
+- an off event without a preceding on event starts at the start of the range
+- an on event without a following off event ends at the end of the range
+
+Cycles that span several periods are split over them, a cycle is counted
+in the period it started. Periods are days or months in a given timezone,
+so they follow its daylight saving time changes (eg. a 23 hour day).
+"""
+
+from .smappy import to_milliseconds
+
+FREQS = ('D', 'M')
+
+
+def events_to_arrays(events):
+    """
+    Parameters
+    ----------
+    events : [dict]
+        as returned by Smappee.get_events, possibly for several appliances
+
+    Returns
+    -------
+    (np.ndarray, np.ndarray, np.ndarray)
+        appliance ids (int64), timestamps (int64, epoch milliseconds) and
+        active power (float64, W)
+    """
+    import numpy as np
+
+    n = len(events)
+    appliances = np.fromiter((e['applianceId'] for e in events),
+                             dtype=np.int64, count=n)
+    timestamps = np.fromiter((e['timestamp'] for e in events),
+                             dtype=np.int64, count=n)
+    power = np.fromiter((e['activePower'] for e in events),
+                        dtype=np.float64, count=n)
+    return appliances, timestamps, power
+
+
+def pair_events(appliances, timestamps, power, start, end):
+    """
+    Pair on and off events to cycles
+
+    Parameters
+    ----------
+    appliances : np.ndarray
+    timestamps : np.ndarray
+    power : np.ndarray
+        see events_to_arrays
+    start : int
+    end : int
+        epoch milliseconds, the range the events were requested for
+
+    Returns
+    -------
+    (np.ndarray, np.ndarray, np.ndarray, np.ndarray)
+        per cycle: appliance id, start and end (epoch milliseconds)
+        and power (W)
+    """
+    import numpy as np
+
+    order = np.lexsort((timestamps, appliances))
+    appliances = appliances[order]
+    timestamps = timestamps[order]
+    power = power[order]
+    on = power > 0
+
+    # collapse repeated states of the same appliance
+    first = np.ones(len(on), dtype=bool)
+    first[1:] = appliances[1:] != appliances[:-1]
+    keep = first.copy()
+    keep[1:] |= on[1:] != on[:-1]
+    appliances = appliances[keep]
+    timestamps = timestamps[keep]
+    power = power[keep]
+    on = on[keep]
+    first = first[keep]
+    # after collapsing, states alternate per appliance
+    last = np.ones(len(on), dtype=bool)
+    last[:-1] = appliances[:-1] != appliances[1:]
+
+    # cycles starting with an on event, ending at the next (off) event or
+    # at the end of the range
+    i = np.flatnonzero(on)
+    truncated_end = last[i]
+    next_i = np.minimum(i + 1, len(on) - 1)
+    cycle_end = np.where(truncated_end, end, timestamps[next_i])
+
+    # cycles ending with an off event at the start of the range
+    j = np.flatnonzero(~on & first)
+
+    cycle_appliances = np.concatenate([appliances[i], appliances[j]])
+    cycle_starts = np.concatenate([timestamps[i],
+                                   np.full(len(j), start, dtype=np.int64)])
+    cycle_ends = np.concatenate([cycle_end, timestamps[j]])
+    cycle_power = np.concatenate([power[i], -power[j]])
+    return cycle_appliances, cycle_starts, cycle_ends, cycle_power
+
+
+def period_edges(start, end, freq, timezone):
+    """
+    Parameters
+    ----------
+    start : int
+    end : int
+        epoch milliseconds
+    freq : str
+        'D' or 'M'
+    timezone : str
+
+    Returns
+    -------
+    np.ndarray
+        epoch milliseconds (int64) of the starts of the local periods
+        covering start to end, followed by the end of the last one
+    """
+    import numpy as np
+    import pandas as pd
+
+    first, last = (pd.Timestamp(t, unit='ms', tz='UTC').tz_convert(timezone)
+                   .tz_localize(None) for t in (start, end))
+    periods = pd.period_range(first, last, freq=freq)
+    edges = pd.period_range(periods[0], periods[-1] + 1,
+                            freq=freq).to_timestamp()
+    # a midnight that doesn't exist or exists twice (DST changes at
+    # midnight) is shifted to the first instant of the period
+    edges = edges.tz_localize(timezone, nonexistent='shift_forward',
+                              ambiguous=np.ones(len(edges), dtype=bool))
+    return edges.values.astype('datetime64[ms]').astype(np.int64)
+
+
+def appliance_usage(events, start, end, freq='D', timezone=None):
+    """
+    Per appliance and per period: the number of cycles, the runtime,
+    the estimated energy and power statistics
+
+    Parameters
+    ----------
+    events : [dict]
+        as returned by Smappee.get_events, possibly for several appliances
+    start : int | dt.datetime | pd.Timestamp
+    end : int | dt.datetime | pd.Timestamp
+        the range the events were requested for,
+        start and end support epoch (in milliseconds),
+        datetime and Pandas Timestamp
+        timezone-naive datetimes are assumed to be in UTC
+    freq : str
+        'D' (default) for days, 'M' for months
+    timezone : str, optional
+        timezone of the days and months, eg. the 'timezone' of
+        get_service_location_info, default UTC
+
+    Returns
+    -------
+    pd.DataFrame
+        indexed by applianceId and period (start of the period, in
+        timezone), with columns
+        cycles, duration (seconds), energy (kWh),
+        mean_power (W, time weighted) and max_power (W)
+    """
+    import numpy as np
+    import pandas as pd
+
+    if freq not in FREQS:
+        raise ValueError("freq must be one of {}".format(sorted(FREQS)))
+    if timezone is None:
+        timezone = 'UTC'
+    start = to_milliseconds(start)
+    end = to_milliseconds(end)
+
+    appliances, starts, ends, power = pair_events(
+        *events_to_arrays(events), start=start, end=end)
+    keep = ends > starts
+    appliances = appliances[keep]
+    starts = starts[keep]
+    ends = ends[keep]
+    power = power[keep]
+
+    # split cycles over the periods they span
+    # events outside start to end are kept, cover them too
+    edges = period_edges(min(starts.min(initial=start), start),
+                         max(ends.max(initial=end), end), freq, timezone)
+    first_period = np.searchsorted(edges, starts, side='right') - 1
+    last_period = np.searchsorted(edges, ends - 1, side='right') - 1
+    n = last_period - first_period + 1
+    idx = np.repeat(np.arange(len(n)), n)
+    offset = np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n)
+    period = first_period[idx] + offset
+    period_start = edges[period]
+    period_end = edges[period + 1]
+    piece_start = np.maximum(starts[idx], period_start)
+    piece_end = np.minimum(ends[idx], period_end)
+
+    duration = (piece_end - piece_start) / 1e3
+    df = pd.DataFrame({
+        'applianceId': appliances[idx],
+        'period': pd.to_datetime(period_start, unit='ms',
+                                 utc=True).tz_convert(timezone),
+        'cycles': (offset == 0).astype(np.int64),
+        'duration': duration,
+        'energy': power[idx] * duration / 3.6e6,
+        'max_power': power[idx]
+    })
+    usage = df.groupby(['applianceId', 'period']).agg(
+        {'cycles': 'sum', 'duration': 'sum', 'energy': 'sum',
+         'max_power': 'max'})
+    usage['mean_power'] = usage['energy'] * 3.6e6 / usage['duration']
+    return usage[['cycles', 'duration', 'energy', 'mean_power', 'max_power']]